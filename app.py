@@ -1,92 +1,337 @@
 import os
-from flask import Flask, jsonify
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import Flask, Response, request
 from flask_cors import CORS
 import requests
-from datetime import datetime
-from database import BartDatabase
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from redis import Redis
+import ijson
+import orjson
+from datetime import datetime, timedelta
+from apscheduler.schedulers.background import BackgroundScheduler
+from database import BartDatabase, day_bounds
 
 app = Flask(__name__)
 CORS(app)
 
+def ojsonify(data):
+    """Serialize data with orjson; naive datetimes are emitted as UTC"""
+    return Response(orjson.dumps(data, option=orjson.OPT_NAIVE_UTC), mimetype='application/json')
+
+# Shared database connection, opened lazily so that under gunicorn --preload
+# each worker opens its own after fork (SQLite connections must not cross fork)
+DB = None
+_db_lock = threading.Lock()
+
+def get_db():
+    """Return this process's database connection, opening it on first use"""
+    global DB
+    if DB is None:
+        with _db_lock:
+            if DB is None:
+                DB = BartDatabase()
+    return DB
+
+def rollup_daily_stats():
+    """Refresh the daily_stats rollups that back the station analytics"""
+    try:
+        db = BartDatabase()
+        try:
+            db.rollup_recent_days()
+        finally:
+            db.close()
+    except Exception as e:
+        print(f"Error rolling up daily stats: {str(e)}")
+
+def start_scheduler():
+    """Start the daily_stats rollup jobs.
+    
+    Called from the __main__ block and from gunicorn's when_ready hook (so it
+    runs once, in the master), never at import.
+    """
+    # Roll up each completed day just after midnight UTC, and shortly after
+    # startup (once gunicorn has forked its workers) to backfill any days
+    # missed while the app was down
+    scheduler = BackgroundScheduler(daemon=True, timezone='UTC')
+    scheduler.add_job(rollup_daily_stats, 'cron', hour=0, minute=5)
+    scheduler.add_job(rollup_daily_stats, next_run_time=datetime.utcnow() + timedelta(seconds=30))
+    scheduler.start()
+    return scheduler
+
+# Analytics queries, shared with the query plan debug route.
+# Station stats for the last 7 days: completed days come from the nightly
+# rollup, and everything after the last rolled-up day (today, plus yesterday
+# until its rollup has run) from the raw departures.
+STATION_ANALYTICS_SQL = '''
+WITH rollup AS (
+    SELECT date, destination, total_departures, delayed_departures, total_delay_minutes
+    FROM destination_daily_stats
+    WHERE date >= ? AND date < ?
+)
+SELECT 
+    COALESCE(destination, 'Unknown') as destination,
+    COALESCE(SUM(total_departures), 0) as total_departures,
+    COALESCE(SUM(delayed_departures), 0) as delayed_trains,
+    CAST(COALESCE(SUM(total_delay_minutes) * 1.0 / SUM(total_departures), 0) AS REAL) as avg_delay_minutes
+FROM (
+    SELECT destination, total_departures, delayed_departures, total_delay_minutes
+    FROM rollup
+    UNION ALL
+    SELECT 
+        destination,
+        COUNT(*),
+        COUNT(CASE WHEN delay != 0 THEN 1 END),
+        SUM(ABS(delay))
+    FROM departures
+    WHERE timestamp >= COALESCE(
+        (SELECT CAST(strftime('%s', MAX(date), '+1 day') AS INTEGER) FROM rollup), ?
+    ) AND timestamp < ?
+    GROUP BY destination
+)
+GROUP BY destination
+ORDER BY total_departures DESC
+'''
+
+# Station ridership and system status for today in a single scan
+PERFORMANCE_SQL = '''
+SELECT 
+    COUNT(CASE WHEN station_id = ? THEN 1 END) as total_departures,
+    COUNT(CASE WHEN station_id = ? AND delay = 0 THEN 1 END) as on_time,
+    CAST(COALESCE(AVG(CASE WHEN station_id = ? THEN delay END), 0) AS REAL) as avg_delay,
+    COUNT(DISTINCT destination) as active_trains,
+    COUNT(CASE WHEN delay > 0 THEN 1 END) as delayed_trains
+FROM departures
+WHERE timestamp >= ? AND timestamp < ?
+'''
+
+def station_analytics_params():
+    today = datetime.utcnow().date()
+    week_ago = today - timedelta(days=7)
+    return (week_ago.isoformat(), today.isoformat(), day_bounds(week_ago)[0], day_bounds(today)[1])
+
+def performance_params(station):
+    return (station, station, station, *day_bounds())
+
 # BART API configuration
 BART_API_KEY = 'MW9S-E7SL-26DU-VV8V'  # This is a public test key
 BART_API_BASE_URL = 'http://api.bart.gov/api'
+BART_API_TIMEOUT = (2, 5)  # (connect, read) seconds
+BART_STATIONS_URL = f'{BART_API_BASE_URL}/stn.aspx'
+BART_ETD_URL = f'{BART_API_BASE_URL}/etd.aspx'
+BART_STATIONS_PARAMS = {'cmd': 'stns', 'key': BART_API_KEY, 'json': 'y'}
+BART_ETD_PARAMS = {'cmd': 'etd', 'key': BART_API_KEY, 'json': 'y'}
+
+# Shared HTTP session so upstream calls reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'Bart-Web-App/1.0'})
+_adapter = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+)
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+
+# Cap concurrent upstream calls below the worker's thread count (see gunicorn.conf.py)
+# so a slow BART API can't tie up every thread; excess calls fail fast with a 503
+BART_MAX_CONCURRENCY = 6
+BART_SLOT_TIMEOUT = 0.5  # Seconds to wait for a free slot
+_bart_slots = threading.BoundedSemaphore(BART_MAX_CONCURRENCY)
+
+class BartBusyError(Exception):
+    """Raised when every upstream BART call slot is in use"""
+
+@contextmanager
+def bart_stream(url, params):
+    """Call a BART API endpoint and yield its JSON body as a file-like stream"""
+    if not _bart_slots.acquire(timeout=BART_SLOT_TIMEOUT):
+        raise BartBusyError("Too many concurrent BART API requests")
+    try:
+        with SESSION.get(url, params=params, timeout=BART_API_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            # Let urllib3 undo any gzip/deflate transfer encoding while reading
+            response.raw.decode_content = True
+            yield response.raw
+    finally:
+        _bart_slots.release()
+
+# Redis cache configuration (caching is disabled when REDIS_URL is unset)
+REDIS_URL = os.environ.get('REDIS_URL')
+STATIONS_CACHE_TTL = 24 * 60 * 60  # Station list rarely changes
+DEPARTURES_CACHE_TTL = 20  # Matches BART's ETD refresh cadence
+ANALYTICS_CACHE_TTL = 15  # Dashboards poll often; aggregates only move on ingest
+CACHE_REFRESH_WAIT = 1.0  # Seconds to wait for another worker's refresh
+
+REDIS_TIMEOUT = 0.3  # Seconds; a slow or unreachable Redis counts as a cache miss
+
+redis_client = Redis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=REDIS_TIMEOUT,
+    socket_timeout=REDIS_TIMEOUT
+) if REDIS_URL else None
+
+def cache_get(key):
+    """Return the cached JSON body for key, or None on a miss"""
+    if redis_client is None:
+        return None
+    try:
+        return redis_client.get(key)
+    except Exception as e:
+        print(f"Error reading cache key {key}: {str(e)}")
+        return None
+
+def cache_set(key, ttl, body):
+    """Cache a JSON body under key for ttl seconds"""
+    if redis_client is None:
+        return
+    try:
+        redis_client.setex(key, ttl, body)
+    except Exception as e:
+        print(f"Error writing cache key {key}: {str(e)}")
+
+def cache_lock(key, ttl):
+    """Try to take the refresh lock for key; True if this caller should rebuild it"""
+    if redis_client is None:
+        return True
+    try:
+        return bool(redis_client.set(f'{key}:lock', 1, nx=True, ex=ttl))
+    except Exception as e:
+        print(f"Error locking cache key {key}: {str(e)}")
+        return True
+
+def cache_unlock(key):
+    if redis_client is None:
+        return
+    try:
+        redis_client.delete(f'{key}:lock')
+    except Exception as e:
+        print(f"Error unlocking cache key {key}: {str(e)}")
+
+def cached_json(key_template, ttl):
+    """Cache a view's successful JSON response in Redis.
+    
+    On a miss only the caller holding the refresh lock runs the view; others
+    briefly wait for its result before falling back to running it themselves.
+    Expiry is jittered so keys don't all expire together.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            key = key_template.format(**kwargs)
+            body = cache_get(key)
+            
+            locked = False
+            if body is None:
+                locked = cache_lock(key, ttl)
+                if not locked:
+                    deadline = time.monotonic() + CACHE_REFRESH_WAIT
+                    while body is None and time.monotonic() < deadline:
+                        time.sleep(0.05)
+                        body = cache_get(key)
+            
+            if body is None:
+                try:
+                    result = view(**kwargs)
+                    if isinstance(result, tuple) or result.status_code != 200:
+                        return result
+                    body = result.get_data()
+                    cache_set(key, ttl + random.randint(0, ttl // 5), body)
+                finally:
+                    if locked:
+                        cache_unlock(key)
+            
+            response = Response(body, mimetype='application/json')
+            response.headers['Cache-Control'] = f'public, max-age={ttl}'
+            return response
+        return wrapper
+    return decorator
 
 @app.route('/', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
+    return ojsonify({
         "status": "healthy",
         "message": "BART API is running",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.utcnow()
     })
 
 @app.route('/api/stations', methods=['GET'])
 def get_stations():
     """Get list of BART stations"""
+    cached = cache_get('bart:stations')
+    if cached:
+        return Response(cached, mimetype='application/json')
+    
     try:
-        response = requests.get(f'{BART_API_BASE_URL}/stn.aspx', params={
-            'cmd': 'stns',
-            'key': BART_API_KEY,
-            'json': 'y'
-        })
-        response.raise_for_status()
-        data = response.json()
-        
         stations = []
-        for station in data['root']['stations']['station']:
-            stations.append({
-                'name': station['name'],
-                'abbr': station['abbr']
-            })
+        with bart_stream(BART_STATIONS_URL, BART_STATIONS_PARAMS) as body:
+            for station in ijson.items(body, 'root.stations.station.item'):
+                stations.append({
+                    'name': station['name'],
+                    'abbr': station['abbr']
+                })
+        
+        # BART reports errors as HTTP 200 with root.message.error and no stations
+        if not stations:
+            raise ValueError("BART API returned no stations")
         
-        return jsonify(stations)
+        result = ojsonify(stations)
+        cache_set('bart:stations', STATIONS_CACHE_TTL, result.get_data())
+        return result
+    except BartBusyError as e:
+        return ojsonify({"error": str(e)}), 503
     except Exception as e:
         print(f"Error fetching stations: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}), 500
 
 @app.route('/api/departures/<station>', methods=['GET'])
 def get_departures(station):
     """Get real-time departures for a specific station"""
+    cache_key = f'bart:etd:{station}'
+    cached = cache_get(cache_key)
+    if cached:
+        return Response(cached, mimetype='application/json')
+    
     try:
-        response = requests.get(f'{BART_API_BASE_URL}/etd.aspx', params={
-            'cmd': 'etd',
-            'orig': station,
-            'key': BART_API_KEY,
-            'json': 'y'
-        })
-        response.raise_for_status()
-        data = response.json()
-        
-        departures = []
-        if 'root' in data and 'station' in data['root']:
-            station_data = data['root']['station'][0]
-            if 'etd' in station_data:
-                for etd in station_data['etd']:
-                    destination = etd['destination']
-                    for estimate in etd['estimate']:
-                        departure = {
-                            'timestamp': datetime.now().isoformat(),
-                            'destination': destination,
-                            'minutes': int(estimate['minutes'] if estimate['minutes'] != 'Leaving' else '0'),
-                            'platform': estimate['platform'],
-                            'direction': estimate['direction'],
-                            'delay': 0,  # BART API doesn't provide delay info
-                            'length': int(estimate['length'])
-                        }
-                        departures.append(departure)
+        now = datetime.utcnow()
+        with bart_stream(BART_ETD_URL, {**BART_ETD_PARAMS, 'orig': station}) as body:
+            # Parse each etd entry as it arrives instead of buffering the whole payload
+            etds = ijson.items(body, 'root.station.item.etd.item')
+            departures = [{
+                'timestamp': now,
+                'destination': etd['destination'],
+                'minutes': 0 if estimate['minutes'] == 'Leaving' else int(estimate['minutes']),
+                'platform': estimate['platform'],
+                'direction': estimate['direction'],
+                'delay': 0,  # BART API doesn't provide delay info
+                'length': int(estimate['length'])
+            } for etd in etds for estimate in etd['estimate']]
         
-        return jsonify({
+        result = ojsonify({
             "status": "Data available",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": now,
             "departures": departures
         })
+        cache_set(cache_key, DEPARTURES_CACHE_TTL, result.get_data())
+        return result
         
+    except BartBusyError as e:
+        return ojsonify({
+            "status": "Error",
+            "timestamp": datetime.utcnow(),
+            "error": str(e),
+            "departures": []
+        }), 503
     except Exception as e:
         print(f"Error fetching departures: {str(e)}")
-        return jsonify({
+        return ojsonify({
             "status": "Error",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.utcnow(),
             "error": str(e),
             "departures": []
         }), 500
@@ -96,108 +341,87 @@ def get_daily_analytics():
     """Get daily analytics for the past week"""
     # This endpoint would need to be modified to work with historical data
     # For now, returning empty analytics with status
-    return jsonify({
+    return ojsonify({
         "status": "No historical data available",
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": datetime.utcnow(),
         "data": []
     })
 
 @app.route('/api/analytics/stations', methods=['GET'])
+@cached_json('analytics:stations', ANALYTICS_CACHE_TTL)
 def get_station_analytics():
     """Get analytics by station"""
     try:
-        db = BartDatabase(db_path='bart_history.db')
-        cursor = db.conn.cursor()
+        cursor = get_db().conn.cursor()
         
         # Get station stats for the last 7 days
-        cursor.execute('''
-        SELECT 
-            d.destination,
-            COUNT(*) as total_departures,
-            COUNT(CASE WHEN d.delay != 0 THEN 1 END) as delayed_trains,
-            ROUND(COALESCE(AVG(ABS(d.delay)), 0), 1) as avg_delay_minutes
-        FROM departures d
-        WHERE d.timestamp >= datetime('now', '-7 days')
-        GROUP BY d.destination
-        ORDER BY total_departures DESC
-        ''')
+        cursor.execute(STATION_ANALYTICS_SQL, station_analytics_params())
         
         stats = cursor.fetchall()
-        db.close()
         
         # Format the data
-        analytics = []
-        for stat in stats:
-            analytics.append({
-                'destination': stat[0] or 'Unknown',
-                'total_departures': stat[1] or 0,
-                'delayed_trains': stat[2] or 0,
-                'avg_delay_minutes': float(stat[3] or 0)
-            })
+        analytics = [{
+            'destination': stat['destination'],
+            'total_departures': stat['total_departures'],
+            'delayed_trains': stat['delayed_trains'],
+            'avg_delay_minutes': round(stat['avg_delay_minutes'], 1)
+        } for stat in stats]
         
         # If no data found, return empty array with success status
         if not analytics:
-            return jsonify({
+            return ojsonify({
                 "status": "No data available",
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": datetime.utcnow(),
                 "data": []
             })
         
-        return jsonify({
+        return ojsonify({
             "status": "Data available",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.utcnow(),
             "data": analytics
         })
         
     except Exception as e:
         print(f"Error in get_station_analytics: {str(e)}")
-        return jsonify({
+        return ojsonify({
             "status": "Error",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.utcnow(),
             "error": str(e),
             "data": []
         }), 500
 
+@app.route('/api/debug/plans', methods=['GET'])
+def get_query_plans():
+    """Get SQLite query plans for the analytics queries (development only)"""
+    if app.config['ENV'] != 'development':
+        return ojsonify({"error": "Not found"}), 404
+    
+    station = request.args.get('station', '12TH')
+    return ojsonify({
+        "station_analytics": [row[3] for row in get_db().explain(STATION_ANALYTICS_SQL, station_analytics_params())],
+        "performance": [row[3] for row in get_db().explain(PERFORMANCE_SQL, performance_params(station))]
+    })
+
 @app.route('/api/performance/<station>', methods=['GET'])
+@cached_json('perf:{station}', ANALYTICS_CACHE_TTL)
 def get_performance_data(station):
     """Get performance data for a specific station"""
     try:
-        db = BartDatabase()
-        cursor = db.conn.cursor()
+        cursor = get_db().conn.cursor()
         
-        # Get ridership data for today
-        cursor.execute('''
-        SELECT 
-            COUNT(*) as total_departures,
-            COUNT(CASE WHEN delay = 0 THEN 1 END) as on_time,
-            AVG(delay) as avg_delay
-        FROM departures
-        WHERE station_id = ? AND date(timestamp) = date('now')
-        ''', (station,))
+        # Get station ridership and system status for today in a single scan
+        cursor.execute(PERFORMANCE_SQL, performance_params(station))
         
         stats = cursor.fetchone()
         
-        # Get system status
-        cursor.execute('''
-        SELECT 
-            COUNT(DISTINCT destination) as active_trains,
-            COUNT(CASE WHEN delay > 0 THEN 1 END) as delayed_trains
-        FROM departures
-        WHERE date(timestamp) = date('now')
-        ''')
-        
-        system_stats = cursor.fetchone()
-        
-        db.close()
-        
         # Format the response
         performance_data = {
-            "ridership": stats[0] or 0,
-            "onTimeRate": round((stats[1] / stats[0] * 100) if stats[0] > 0 else 0, 1),
-            "avgDelay": round(stats[2] or 0, 1),
+            "ridership": stats['total_departures'],
+            "onTimeRate": round((stats['on_time'] / stats['total_departures'] * 100) if stats['total_departures'] > 0 else 0, 1),
+            "avgDelay": round(stats['avg_delay'], 1),
             "systemStatus": {
-                "activeTrains": system_stats[0] or 0,
-                "delays": system_stats[1] or 0,
+                "activeTrains": stats['active_trains'],
+                "delays": stats['delayed_trains'],
                 "elevators": {
                     "total": 50,  # This would come from BART API
                     "down": 2     # This would come from BART API
@@ -209,14 +433,14 @@ def get_performance_data(station):
             }
         }
         
-        return jsonify({
+        return ojsonify({
             "status": "success",
             "data": performance_data
         })
         
     except Exception as e:
         print(f"Error in get_performance_data: {str(e)}")
-        return jsonify({
+        return ojsonify({
             "status": "error",
             "error": str(e)
         }), 500
@@ -224,4 +448,5 @@ def get_performance_data(station):
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     print(f"Starting Flask app on port {port}")
+    start_scheduler()
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -1,9 +1,37 @@
 import sqlite3
-from datetime import datetime
+import threading
+from datetime import datetime, date, time, timedelta, timezone
 import os
 
+# Hot write statements, kept as module-level constants so every call reuses
+# the same prepared statement from the connection's statement cache
+INSERT_STATION_SQL = '''
+INSERT OR REPLACE INTO stations 
+(id, name, abbr, city, county, state, zipcode)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+INSERT_DEPARTURE_SQL = '''
+INSERT INTO departures 
+(station_id, destination, platform, minutes, direction, color, length, bike_flag, delay, timestamp, date)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def day_bounds(day=None):
+    """Return the half-open [start, end) epoch-seconds range covering a UTC day.
+    
+    Range predicates on the integer timestamp column can use its indexes.
+    """
+    if day is None:
+        day = datetime.utcnow().date()
+    elif isinstance(day, str):
+        day = date.fromisoformat(day)
+    start = datetime.combine(day, time.min, tzinfo=timezone.utc)
+    end = start + timedelta(days=1)
+    return int(start.timestamp()), int(end.timestamp())
+
 class BartDatabase:
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, init_schema=True):
         # Railway persistent storage path
         if db_path is None:
             # Check if we're in Railway environment
@@ -23,10 +51,43 @@ class BartDatabase:
             db_path = 'bart.db'
         
         print(f"Using database path: {db_path}")
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.create_tables()
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=256)
+        self.conn.row_factory = sqlite3.Row
+        # The connection is shared across request threads; serialize writes
+        self.lock = threading.Lock()
+        # WAL lets readers proceed alongside a writer; the rest are per-connection tuning
+        self.conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-64000;
+        PRAGMA mmap_size=268435456;
+        PRAGMA busy_timeout=5000;
+        ''')
+        if init_schema:
+            self.create_tables()
+    
+    def needs_migration(self):
+        """Return True if the database predates the epoch-timestamp schema"""
+        columns = {row['name']: row['type'] for row in self.conn.execute('PRAGMA table_info(departures)')}
+        if columns and columns.get('timestamp') != 'INTEGER':
+            return True
+        
+        rollup = self.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'daily_stats'"
+        ).fetchone()
+        return rollup is not None and 'WITHOUT ROWID' not in rollup['sql']
     
     def create_tables(self):
+        # Legacy TEXT timestamps never match the integer day bounds, so refuse
+        # to run against them rather than silently report zeros
+        if self.needs_migration():
+            raise RuntimeError(
+                f"Database {self.db_path} uses the old timestamp schema; "
+                f"run `python migrate_timestamps.py {self.db_path}` first"
+            )
+        
         cursor = self.conn.cursor()
         
         # Create stations table
@@ -56,7 +117,7 @@ class BartDatabase:
             length INTEGER,
             bike_flag INTEGER,
             delay INTEGER DEFAULT 0,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            timestamp INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
             date DATE,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (station_id) REFERENCES stations(id)
@@ -66,7 +127,6 @@ class BartDatabase:
         # Create daily_stats table
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS daily_stats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
             station_id TEXT NOT NULL,
             date DATE NOT NULL,
             total_departures INTEGER DEFAULT 0,
@@ -74,37 +134,62 @@ class BartDatabase:
             avg_delay_minutes REAL DEFAULT 0,
             max_delay_minutes INTEGER DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (station_id, date),
             FOREIGN KEY (station_id) REFERENCES stations(id)
-        )
+        ) WITHOUT ROWID
+        ''')
+        
+        # Create destination_daily_stats table (rollup behind the station analytics)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS destination_daily_stats (
+            date DATE NOT NULL,
+            destination TEXT NOT NULL,
+            total_departures INTEGER DEFAULT 0,
+            delayed_departures INTEGER DEFAULT 0,
+            total_delay_minutes INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (date, destination)
+        ) WITHOUT ROWID
+        ''')
+        
+        # Covering indexes for the analytics queries: timestamp-range scans
+        # (destination rollup, system-wide stats) and per-station daily stats
+        existing_indexes = {
+            row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        }
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_dep_ts_dest_station
+        ON departures(timestamp, destination, delay, station_id)
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_dep_station_ts
+        ON departures(station_id, timestamp, delay, destination)
         ''')
         
         self.conn.commit()
+        
+        # Refresh planner statistics so newly built indexes get picked. Every
+        # worker and rollup job opens through here, so skip it otherwise.
+        if not {'idx_dep_ts_dest_station', 'idx_dep_station_ts'} <= existing_indexes:
+            cursor.execute('ANALYZE')
+            self.conn.commit()
         print("Database tables created successfully")
     
     def save_station(self, station_data):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-        INSERT OR REPLACE INTO stations 
-        (id, name, abbr, city, county, state, zipcode)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            station_data['id'],
-            station_data['name'],
-            station_data['abbr'],
-            station_data.get('city'),
-            station_data.get('county'),
-            station_data.get('state'),
-            station_data.get('zipcode')
-        ))
-        self.conn.commit()
+        with self.lock:
+            self.conn.execute(INSERT_STATION_SQL, (
+                station_data['id'],
+                station_data['name'],
+                station_data['abbr'],
+                station_data.get('city'),
+                station_data.get('county'),
+                station_data.get('state'),
+                station_data.get('zipcode')
+            ))
+            self.conn.commit()
     
-    def save_departure(self, departure_data):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-        INSERT INTO departures 
-        (station_id, destination, platform, minutes, direction, color, length, bike_flag, delay, date)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+    def _departure_row(self, departure_data, now):
+        return (
             departure_data['station_id'],
             departure_data['destination'],
             departure_data.get('platform'),
@@ -114,41 +199,92 @@ class BartDatabase:
             departure_data.get('length'),
             departure_data.get('bike_flag'),
             departure_data.get('delay', 0),
-            datetime.now().strftime('%Y-%m-%d')
-        ))
-        self.conn.commit()
+            int(now.timestamp()),
+            now.strftime('%Y-%m-%d')
+        )
+    
+    def save_departure(self, departure_data):
+        row = self._departure_row(departure_data, datetime.now())
+        with self.lock, self.conn:
+            self.conn.execute(INSERT_DEPARTURE_SQL, row)
+    
+    def save_departures(self, departures):
+        """Insert a batch of departures in a single transaction"""
+        now = datetime.now()
+        rows = [self._departure_row(departure_data, now) for departure_data in departures]
+        
+        with self.lock, self.conn:
+            self.conn.executemany(INSERT_DEPARTURE_SQL, rows)
     
     def update_daily_stats(self, station_id, date):
+        with self.lock:
+            cursor = self.conn.cursor()
+            
+            # Calculate stats for the day
+            cursor.execute('''
+            SELECT 
+                COUNT(*) as total,
+                SUM(CASE WHEN delay > 0 THEN 1 ELSE 0 END) as delayed,
+                AVG(CASE WHEN delay > 0 THEN delay ELSE NULL END) as avg_delay,
+                MAX(CASE WHEN delay > 0 THEN delay ELSE 0 END) as max_delay
+            FROM departures
+            WHERE station_id = ? AND timestamp >= ? AND timestamp < ?
+            ''', (station_id, *day_bounds(date)))
+            
+            stats = cursor.fetchone()
+            
+            # Update or insert stats
+            cursor.execute('''
+            INSERT OR REPLACE INTO daily_stats 
+            (station_id, date, total_departures, delayed_departures, avg_delay_minutes, max_delay_minutes)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (
+                station_id,
+                date,
+                stats[0] or 0,
+                stats[1] or 0,
+                stats[2] or 0,
+                stats[3] or 0
+            ))
+            
+            self.conn.commit()
+    
+    def update_destination_stats(self, date):
+        start, end = day_bounds(date)
+        with self.lock, self.conn:
+            self.conn.execute('''
+            INSERT OR REPLACE INTO destination_daily_stats 
+            (date, destination, total_departures, delayed_departures, total_delay_minutes)
+            SELECT 
+                ?,
+                destination,
+                COUNT(*),
+                COUNT(CASE WHEN delay != 0 THEN 1 END),
+                COALESCE(SUM(ABS(delay)), 0)
+            FROM departures
+            WHERE timestamp >= ? AND timestamp < ?
+            GROUP BY destination
+            ''', (date, start, end))
+    
+    def rollup_day(self, date):
+        """Materialize daily_stats and destination_daily_stats for one UTC day"""
+        date = str(date)
         cursor = self.conn.cursor()
-        
-        # Calculate stats for the day
         cursor.execute('''
-        SELECT 
-            COUNT(*) as total,
-            SUM(CASE WHEN delay > 0 THEN 1 ELSE 0 END) as delayed,
-            AVG(CASE WHEN delay > 0 THEN delay ELSE NULL END) as avg_delay,
-            MAX(CASE WHEN delay > 0 THEN delay ELSE 0 END) as max_delay
+        SELECT DISTINCT station_id
         FROM departures
-        WHERE station_id = ? AND date(created_at) = ?
-        ''', (station_id, date))
-        
-        stats = cursor.fetchone()
+        WHERE timestamp >= ? AND timestamp < ?
+        ''', day_bounds(date))
         
-        # Update or insert stats
-        cursor.execute('''
-        INSERT OR REPLACE INTO daily_stats 
-        (station_id, date, total_departures, delayed_departures, avg_delay_minutes, max_delay_minutes)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            station_id,
-            date,
-            stats[0] or 0,
-            stats[1] or 0,
-            stats[2] or 0,
-            stats[3] or 0
-        ))
-        
-        self.conn.commit()
+        for (station_id,) in cursor.fetchall():
+            self.update_daily_stats(station_id, date)
+        self.update_destination_stats(date)
+    
+    def rollup_recent_days(self, days=7):
+        """Rebuild the rollups for the completed days in the analytics window"""
+        today = datetime.utcnow().date()
+        for offset in range(1, days + 1):
+            self.rollup_day(today - timedelta(days=offset))
     
     def get_station_stats(self, station_id, days=7):
         cursor = self.conn.cursor()
@@ -167,6 +303,10 @@ class BartDatabase:
         
         return cursor.fetchall()
     
+    def explain(self, sql, params=()):
+        """Return the EXPLAIN QUERY PLAN rows for a query"""
+        return self.conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+    
     def close(self):
         if self.conn:
             self.conn.close()
@@ -0,0 +1,21 @@
+import os
+
+# Gunicorn configuration for production (see Procfile)
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 3))
+worker_class = 'gthread'
+threads = 8
+
+# Import the app once in the master so workers share its loaded code
+preload_app = True
+
+def when_ready(server):
+    # Run the rollup scheduler once, in the master. Its jobs open and close
+    # their own connection, which the forked workers never touch.
+    import app
+    app.start_scheduler()
+
+def post_fork(server, worker):
+    # Open the worker's own SQLite connection now rather than on its first request
+    import app
+    app.get_db()
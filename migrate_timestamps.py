@@ -0,0 +1,96 @@
+"""One-shot migration to the epoch-timestamp schema.
+
+Rebuilds departures with an INTEGER epoch timestamp column and recreates
+daily_stats and destination_daily_stats as WITHOUT ROWID tables keyed on
+their natural primary keys. Back up the database file before running:
+
+    python migrate_timestamps.py [db_path]
+
+Re-running is safe: an already-migrated database is left alone. The old
+tables are renamed to *_old in a single transaction, and a run that failed
+after that resumes from them.
+"""
+import sys
+from database import BartDatabase
+
+TABLES = ['departures', 'daily_stats', 'destination_daily_stats']
+
+# Old indexes move with their renamed tables and would block create_tables
+OLD_INDEXES = ['idx_dep_ts_dest_station', 'idx_dep_station_ts']
+
+def table_exists(conn, name):
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone()
+    return row is not None
+
+def migrate(db_path=None):
+    # Open without create_tables, which refuses to run on the old schema
+    db = BartDatabase(db_path, init_schema=False)
+    conn = db.conn
+
+    if not table_exists(conn, 'departures_old'):
+        if not db.needs_migration():
+            db.create_tables()
+            print("Database already uses the epoch-timestamp schema")
+            db.close()
+            return
+
+        # Move the old tables aside and let create_tables build the new schema.
+        # Databases older than the rollups have no destination_daily_stats.
+        # sqlite3 commits DDL as it goes unless the transaction is explicit,
+        # so BEGIN/COMMIT here to rename all of the tables or none of them.
+        conn.isolation_level = None
+        try:
+            conn.execute('BEGIN')
+            for index in OLD_INDEXES:
+                conn.execute(f'DROP INDEX IF EXISTS {index}')
+            for table in TABLES:
+                if table_exists(conn, table):
+                    conn.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.isolation_level = ''
+    db.create_tables()
+
+    with conn:
+        conn.execute('''
+        INSERT INTO departures
+        (id, station_id, destination, platform, minutes, direction, color, length, bike_flag, delay, timestamp, date, created_at)
+        SELECT
+            id, station_id, destination, platform, minutes, direction, color, length, bike_flag, delay,
+            CAST(COALESCE(strftime('%s', timestamp), strftime('%s', created_at), strftime('%s', 'now')) AS INTEGER),
+            date, created_at
+        FROM departures_old
+        ''')
+
+        # Later rows win if the old table accumulated duplicates per station and day
+        conn.execute('''
+        INSERT OR REPLACE INTO daily_stats
+        (station_id, date, total_departures, delayed_departures, avg_delay_minutes, max_delay_minutes, created_at)
+        SELECT station_id, date, total_departures, delayed_departures, avg_delay_minutes, max_delay_minutes, created_at
+        FROM daily_stats_old
+        ORDER BY id
+        ''')
+
+        if table_exists(conn, 'destination_daily_stats_old'):
+            conn.execute('''
+            INSERT OR REPLACE INTO destination_daily_stats
+            (date, destination, total_departures, delayed_departures, total_delay_minutes, created_at)
+            SELECT date, destination, total_departures, delayed_departures, total_delay_minutes, created_at
+            FROM destination_daily_stats_old
+            ''')
+
+        for table in TABLES:
+            conn.execute(f'DROP TABLE IF EXISTS {table}_old')
+
+    conn.execute('ANALYZE')
+    conn.commit()
+    db.close()
+    print("Migrated database to the epoch-timestamp schema")
+
+if __name__ == '__main__':
+    migrate(sys.argv[1] if len(sys.argv) > 1 else None)